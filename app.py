@@ -1,19 +1,34 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
+import numpy as np
 import requests
-import numpy_financial as npf
-from datetime import datetime, timedelta
-from dateutil.relativedelta import relativedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime
 import base64
+import hashlib
 import json
+import os
+import logging
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
 
+from bond_math import (
+    get_settlement_date,
+    days360_us,
+    last_coupon_date,
+    get_bid_ask_ytm,
+)
+
 # =====================================================
 # PERSISTENCE
 # =====================================================
 STATE_FILE = Path("user_state.json")
 HISTORY_FILE = Path("yield_history.json")
+MASTER_FILE = Path("master_debt.csv")
 
 def load_persistent_state():
     if STATE_FILE.exists():
@@ -21,25 +36,44 @@ def load_persistent_state():
             return json.load(f)
     return {"watchlist": [], "alerts": {}}
 
+def write_json_atomic(path, data):
+    """Write via a temp file + rename so a crash never leaves half a JSON file"""
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
 def save_persistent_state():
-    with open(STATE_FILE, "w") as f:
-        json.dump(
-            {
-                "watchlist": st.session_state.watchlist,
-                "alerts": st.session_state.alerts,
-            },
-            f,
-        )
+    write_json_atomic(
+        STATE_FILE,
+        {
+            "watchlist": list(st.session_state.watchlist),
+            "alerts": st.session_state.alerts,
+        },
+    )
+    st.session_state.state_dirty = False
 
-def load_yield_history():
+def mark_state_dirty():
+    """Defer the state write to the end of the rerun (one write per rerun)"""
+    st.session_state.state_dirty = True
+
+def history_stamp():
+    """(mtime, size) of the history file: changes whenever it is rewritten"""
+    if HISTORY_FILE.exists():
+        stat = HISTORY_FILE.stat()
+        return stat.st_mtime_ns, stat.st_size
+    return None
+
+# Keyed on the file stamp: reruns that didn't touch the file skip the JSON parse
+@st.cache_data(max_entries=2)
+def load_yield_history(stamp):
     if HISTORY_FILE.exists():
         with open(HISTORY_FILE, "r") as f:
             return json.load(f)
     return {}
 
 def save_yield_history(history):
-    with open(HISTORY_FILE, "w") as f:
-        json.dump(history, f)
+    write_json_atomic(HISTORY_FILE, history)
 
 # =====================================================
 # PAGE SETUP
@@ -53,9 +87,12 @@ st.caption(f"Last updated: {datetime.now().strftime('%H:%M:%S')}")
 # =====================================================
 if "initialized" not in st.session_state:
     persisted = load_persistent_state()
-    st.session_state.watchlist = persisted.get("watchlist", [])
+    # Insertion-ordered dict as an ordered set: O(1) membership / add / remove
+    st.session_state.watchlist = dict.fromkeys(persisted.get("watchlist", []))
     st.session_state.alerts = persisted.get("alerts", {})
     st.session_state.last_alert_state = {}
+    st.session_state.last_good_live = pd.DataFrame()
+    st.session_state.state_dirty = False
     st.session_state.initialized = True
 
 # =====================================================
@@ -69,7 +106,8 @@ series_filter = st.sidebar.multiselect(
     default=["GS"]
 )
 
-if st.sidebar.button("🔄 Refresh prices"):
+refresh_clicked = st.sidebar.button("🔄 Refresh prices")
+if refresh_clicked:
     st.cache_data.clear()
 
 st.sidebar.markdown("---")
@@ -107,57 +145,47 @@ max_opportunities = st.sidebar.selectbox(
     index=1
 )
 
+exact_ytm = st.sidebar.checkbox(
+    "Exact YTM (iterative)",
+    value=True,
+    help="Untick for a faster closed-form approximation (display only: "
+         "yield history and 7D yield signals pause while it is off)"
+)
+
 # =====================================================
 # SETTLEMENT DATE (INDIA T+1)
 # =====================================================
-def get_settlement_date():
-    today = datetime.today().date()
-    wd = today.weekday()
-
-    if wd <= 3:
-        return today + timedelta(days=1)
-    elif wd == 4:
-        return today + timedelta(days=3)
-    else:
-        return today + timedelta(days=2)
-
+# Computed per rerun here (not at bond_math import) so it rolls over at midnight
 SETTLEMENT = get_settlement_date()
 
-# =====================================================
-# 30/360 US (EXCEL MATCH)
-# =====================================================
-def days360_us(start, end):
-    d1, d2 = start.day, end.day
-    m1, m2 = start.month, end.month
-    y1, y2 = start.year, end.year
-
-    if d1 == 31:
-        d1 = 30
-    if d2 == 31 and d1 == 30:
-        d2 = 30
-
-    return 360 * (y2 - y1) + 30 * (m2 - m1) + (d2 - d1)
-
 # =====================================================
 # SOUND HELPERS
 # =====================================================
+# Decoded once per run, not on every play
+NEAR_WAV = base64.b64decode("UklGRigAAABXQVZFZm10IBAAAAABAAEAESsAACJWAAACABAAZGF0YQQAAA==")
+HIT_WAV = base64.b64decode("UklGRlIAAABXQVZFZm10IBAAAAABAAEAESsAACJWAAACABAAZGF0YSIAAAB//38AAP//")
+
 def play_near_sound():
-    beep = "UklGRigAAABXQVZFZm10IBAAAAABAAEAESsAACJWAAACABAAZGF0YQQAAA=="
-    st.audio(base64.b64decode(beep), format="audio/wav")
+    st.audio(NEAR_WAV, format="audio/wav")
 
 def play_hit_sound():
-    beep = "UklGRlIAAABXQVZFZm10IBAAAAABAAEAESsAACJWAAACABAAZGF0YSIAAAB//38AAP//"
-    st.audio(base64.b64decode(beep), format="audio/wav")
+    st.audio(HIT_WAV, format="audio/wav")
 
 # =====================================================
 # MASTER DATA
 # =====================================================
-@st.cache_data(ttl=24 * 3600)
-def load_master():
-    df = pd.read_csv("master_debt.csv")
+MASTER_COLS = ["SYMBOL", "IP RATE", "REDEMPTION DATE"]
+
+def parse_master(settlement):
+    # Only parse the three columns used (headers carry stray spaces / case)
+    df = pd.read_csv(
+        MASTER_FILE,
+        usecols=lambda c: c.strip().upper() in MASTER_COLS,
+        engine="c",
+    )
     df.columns = df.columns.str.strip().str.upper()
 
-    df = df[["SYMBOL", "IP RATE", "REDEMPTION DATE"]]
+    df = df[MASTER_COLS]
 
     df.rename(
         columns={
@@ -167,325 +195,435 @@ def load_master():
         inplace=True,
     )
 
-    df["REDEMPTION DATE"] = pd.to_datetime(
+    # Explicit format skips per-row dateutil guessing; stays datetime64 for .dt use
+    red = pd.to_datetime(
         df["REDEMPTION DATE"],
-        dayfirst=True,
+        format="%d-%b-%y",
         errors="coerce"
-    ).dt.date
+    )
+    # %y puts 69-99 in the 1900s, but every bond listed here matures after 2000
+    df["REDEMPTION DATE"] = red.where(
+        red.dt.year >= 2000, red + pd.DateOffset(years=100)
+    )
 
     df = df.dropna(subset=["REDEMPTION DATE"])
 
     df["Years"] = (
-        pd.to_datetime(df["REDEMPTION DATE"]) -
-        pd.to_datetime(SETTLEMENT)
+        df["REDEMPTION DATE"] - pd.Timestamp(settlement)
     ).dt.days / 365.25
 
-    return df[df["Years"] > 0]
+    df = df[df["Years"] > 0]
+
+    # A few non-G-Sec symbols repeat across series (IMC1, AAFS27B); keep the
+    # nearest maturity so Symbol is a unique key for the live join
+    df = (
+        df.sort_values("REDEMPTION DATE", kind="stable")
+        .drop_duplicates(subset="Symbol", keep="first")
+        .sort_index()
+    )
+
+    df["Symbol"] = df["Symbol"].astype("category")
+
+    return df
+
+# Shared read-only across reruns: cache_resource skips the per-hit pickle copy.
+# Keyed on the file mtime so a replaced CSV is picked up without waiting a day,
+# and on settlement so Years is rebuilt at the midnight rollover, not at TTL expiry.
+@st.cache_resource(ttl=24 * 3600)
+def load_master(mtime, settlement):
+    # Parsed master depends on settlement (Years), so cache one file per day
+    cache = Path(f"master_debt_{settlement:%Y%m%d}.parquet")
+    if cache.exists() and cache.stat().st_mtime >= mtime:
+        return pd.read_parquet(cache)
+
+    df = parse_master(settlement)
+    try:
+        df.to_parquet(cache)
+        for old in Path().glob("master_debt_*.parquet"):
+            if old != cache:
+                old.unlink(missing_ok=True)
+    except OSError:
+        # Read-only deploy: just keep the in-memory copy
+        pass
+    return df
+
+@st.cache_resource(ttl=24 * 3600)
+def index_master(_master, mtime, settlement):
+    """Master keyed on its categorical Symbol, built once for live index joins"""
+    return _master.set_index("Symbol")[["Coupon", "REDEMPTION DATE", "Years"]]
 
 # =====================================================
 # LIVE NSE DATA
 # =====================================================
-@st.cache_data(ttl=5)
-def load_live():
-    rows = []
-
+NSE_HOME = "https://www.nseindia.com"
+
+logger = logging.getLogger(__name__)
+
+@st.cache_resource
+def get_nse_session():
+    """Pooled NSE session shared across reruns (keeps cookies + keep-alive connections)"""
+    s = requests.Session()
+    s.headers.update({
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+        "Accept": "application/json",
+        "Accept-Language": "en-US,en;q=0.9",
+        "Referer": "https://www.nseindia.com/market-data/bonds-traded-in-cm",
+        "Connection": "keep-alive",
+    })
+    s.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        # Jittered backoff on transient NSE throttling / gateway errors; one
+        # quick reconnect, but never re-wait a read timeout (a hung call would
+        # otherwise block the rerun for several timeouts)
+        max_retries=Retry(
+            total=3,
+            connect=1,
+            read=False,
+            backoff_factor=0.3,
+            backoff_jitter=0.3,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=["GET"],
+        ),
+    ))
+
+    # REQUIRED to set NSE cookies (once per session, not once per refresh)
+    s.get(NSE_HOME, timeout=15)
+    time.sleep(1)
+    return s
+
+LIVE_FIELDS = {
+    "symbol": "Symbol",
+    "series": "Series",
+    "buyPrice1": "Bid",
+    "sellPrice1": "Ask",
+    "lastPrice": "LTP",
+    "averagePrice": "Avg",
+    "totalTradedVolume": "Volume",
+}
+
+LIVE_DTYPES = {
+    "Bid": "float64",
+    "Ask": "float64",
+    "LTP": "float64",
+    "Avg": "float64",
+    "Volume": "int64",
+}
+
+@st.cache_resource
+def get_last_payload():
+    """Digest + parsed frame of the last NSE payload, shared across sessions"""
+    return {"digest": None, "live": pd.DataFrame()}
+
+def fetch_live():
+    """Live quotes frame (empty for a quiet market), or None if the fetch failed"""
     try:
-        s = requests.Session()
-        s.headers.update({
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
-            "Accept": "application/json",
-            "Accept-Language": "en-US,en;q=0.9",
-            "Referer": "https://www.nseindia.com/market-data/bonds-traded-in-cm",
-            "Connection": "keep-alive",
-        })
-
-        # REQUIRED to set NSE cookies
-        s.get("https://www.nseindia.com", timeout=15)
-        time.sleep(1)
+        s = get_nse_session()
 
         url = "https://www.nseindia.com/api/liveBonds-traded-on-cm?type=gsec"
         resp = s.get(url, timeout=15)
 
+        # Cookies expired / rejected: re-warm the shared session once and retry
+        if resp.status_code in (401, 403):
+            get_nse_session.clear()
+            resp = get_nse_session().get(url, timeout=15)
+
         # NSE bot-block / outage
         if resp.status_code != 200:
-            return pd.DataFrame()
+            return None
 
         text = resp.text.strip()
 
         # NSE returns HTML or empty string when blocked
         if not text or not text.startswith("{"):
-            return pd.DataFrame()
+            return None
+
+        # Quiet market: same bytes as the last poll, reuse the parsed frame
+        last = get_last_payload()
+        digest = hashlib.sha1(resp.content).hexdigest()
+        if digest == last["digest"]:
+            return last["live"]
 
         data = resp.json().get("data", [])
 
-        for d in data:
-            if not isinstance(d, dict):
-                continue
+        # Columnar build: one list per field, no per-row dicts for pandas to transpose
+        records = [d for d in data if isinstance(d, dict)]
+        live = pd.DataFrame({
+            col: [d.get(key) for d in records]
+            for key, col in LIVE_FIELDS.items()
+        })
+
+        # Missing / null quotes count as 0 (no bid, no ask, no trade)
+        numeric = list(LIVE_DTYPES)
+        live[numeric] = live[numeric].apply(pd.to_numeric, errors="coerce").fillna(0)
+        live = live.astype(LIVE_DTYPES)
 
-            last_px = d.get("lastPrice") or 0
-            avg_px = d.get("averagePrice") or 0
+        live["Dirty"] = live["LTP"].where(live["LTP"] != 0, live["Avg"])
+        live["Series"] = live["Series"].astype("category")
 
-            rows.append({
-                "Symbol": d.get("symbol"),
-                "Series": d.get("series"),
-                "Bid": d.get("buyPrice1") or 0,
-                "Ask": d.get("sellPrice1") or 0,
-                "LTP": last_px,
-                "Dirty": last_px if last_px != 0 else avg_px,
-                "Volume": d.get("totalTradedVolume") or 0,
-            })
+        live = live[["Symbol", "Series", "Bid", "Ask", "LTP", "Dirty", "Volume"]]
+        last["digest"], last["live"] = digest, live
 
-    except Exception:
-        # NEVER crash the app
-        return pd.DataFrame()
+    except (requests.RequestException, ValueError, TypeError, AttributeError) as e:
+        # Network error or malformed payload: never crash the app, but say why
+        logger.warning("NSE live fetch failed: %r", e)
+        return None
 
-    return pd.DataFrame(rows)
+    return live
+
+# Circuit breaker: after repeated failures stop calling NSE for a while
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 60
+
+@st.cache_resource
+def get_nse_breaker():
+    """Consecutive NSE failure count, shared by every session in the process"""
+    return {"failures": 0, "opened_at": 0.0}
+
+# A manual refresh is an explicit retry: close the breaker too
+if refresh_clicked:
+    get_nse_breaker().update(failures=0, opened_at=0.0)
+
+@st.cache_data(ttl=5)
+def load_live():
+    """(live quotes, ok); ok is False when NSE failed or the breaker is open"""
+    breaker = get_nse_breaker()
+
+    if (
+        breaker["failures"] >= BREAKER_THRESHOLD
+        and time.time() - breaker["opened_at"] < BREAKER_COOLDOWN
+    ):
+        return pd.DataFrame(), False
+
+    live = fetch_live()
+
+    # Only errors trip the breaker; a valid empty payload is just a quiet market
+    if live is None:
+        breaker["failures"] += 1
+        if breaker["failures"] >= BREAKER_THRESHOLD:
+            breaker["opened_at"] = time.time()
+        return pd.DataFrame(), False
+
+    breaker["failures"] = 0
+
+    return live, True
 
 
 # =====================================================
 # LOAD DATA
 # =====================================================
-master = load_master()
-live = load_live()
+def load_in_ctx(loader, ctx, *args):
+    """Run a cached loader on a worker thread attached to this script run"""
+    add_script_run_ctx(threading.current_thread(), ctx)
+    return loader(*args)
+
+master_mtime = MASTER_FILE.stat().st_mtime if MASTER_FILE.exists() else 0
+
+# Master CSV parse and NSE round-trip are independent: overlap them
+ctx = get_script_run_ctx()
+with ThreadPoolExecutor(max_workers=2) as ex:
+    master_future = ex.submit(load_in_ctx, load_master, ctx, master_mtime, SETTLEMENT)
+    live_future = ex.submit(load_in_ctx, load_live, ctx)
+    master, (live, live_ok) = master_future.result(), live_future.result()
+
+# Ride out NSE blips / open breaker on the last good quotes instead of going blank
+# (a quiet market is a valid empty answer, not an outage: no stale fallback)
+if live_ok:
+    if not live.empty:
+        st.session_state.last_good_live = live
+elif not st.session_state.last_good_live.empty:
+    live = st.session_state.last_good_live
+    st.caption("⚠️ NSE unavailable – showing last good prices (stale).")
 
 if master.empty:
     st.error("Master data file (master_debt.csv) not found or empty!")
     st.stop()
 
-if live.empty:
+if live.empty and live_ok:
+    st.info("No bonds traded on NSE yet. Showing master data only.")
+elif live.empty:
     st.warning("⚠️ Live data unavailable from NSE. Showing master data only. Click 'Refresh prices' to retry.")
-    df = master.copy()
-    df["Series"] = ""
-    df["Bid"] = 0
-    df["Ask"] = 0
-    df["LTP"] = 0
-    df["Dirty"] = 0
-    df["Volume"] = 0
-else:
-    df = live.merge(master, on="Symbol", how="left")
-    df = df[df["Series"].isin(series_filter)]
-    df = df.dropna(subset=["Coupon", "Years"])
 
 # =====================================================
-# LAST INTEREST PAID + ACCRUED
-# =====================================================
-def last_coupon_date(redemption):
-    d = redemption
-    while d > SETTLEMENT:
-        d -= relativedelta(months=6)
-    return d
-
-df["Last Interest Paid"] = df["REDEMPTION DATE"].apply(last_coupon_date)
+# ENRICHED MARKET FRAME (CACHED)
+# =====================================================
+# Only reruns when the quotes, master file, series filter, settlement or YTM mode change;
+# widget-only reruns (watchlist, alerts, scanner sliders) hit the cache.
+# _master is not hashed: master_mtime stands in for it as the cache key.
+@st.cache_data(max_entries=8)
+def build_enriched(live, _master, master_mtime, series, settlement, exact):
+    if live.empty:
+        df = _master.copy()
+        df["Series"] = ""
+        df["Bid"] = 0
+        df["Ask"] = 0
+        df["LTP"] = 0
+        df["Dirty"] = 0
+        df["Volume"] = 0
+    else:
+        # Filter on the live side first so the join only touches selected series
+        df = live[live["Series"].isin(series)]
+        # Share master's categories so the join looks up integer codes
+        # (symbols missing from master become NaN and drop out below anyway)
+        df = df.assign(Symbol=df["Symbol"].astype(_master["Symbol"].dtype))
+        # Index lookup against the prebuilt master index (no per-tick hash build)
+        df = df.join(
+            index_master(_master, master_mtime, settlement),
+            on="Symbol",
+            validate="m:1",
+        )
+        df = df.dropna(subset=["Coupon", "Years"])
 
-df["Days Since"] = df.apply(
-    lambda r: days360_us(r["Last Interest Paid"], SETTLEMENT),
-    axis=1,
-)
+    # Last interest paid + accrued (30/360 US)
+    df["Last Interest Paid"] = last_coupon_date(df["REDEMPTION DATE"], settlement)
+    df["Days Since"] = days360_us(df["Last Interest Paid"], settlement)
+    df["Accrued"] = df["Days Since"] * df["Coupon"] / 360
 
-df["Accrued"] = df["Days Since"] * df["Coupon"] / 360
+    df["Bid YTM"], df["Ask YTM"] = get_bid_ask_ytm(df, exact)
 
-# =====================================================
-# YTM CALCULATION HELPER
-# =====================================================
-def calculate_ytm(price, coupon, years):
-    """Generic YTM calculator"""
-    if pd.isna(price) or price is None or price <= 0:
-        return None
-    
-    if years <= 0 or coupon <= 0:
-        return None
-    
-    try:
-        ytm = npf.rate(
-            nper=years * 2,
-            pmt=coupon / 2,
-            pv=-price,
-            fv=100,
-        ) * 2 * 100
-        
-        if -10 < ytm < 50:
-            return ytm
-        else:
-            return None
-    except:
-        return None
+    # Bid-ask spread
+    df["Spread"] = df["Ask"] - df["Bid"]
 
-# =====================================================
-# BID YTM (SELLING YIELD)
-# =====================================================
-def get_bid_ytm(r):
-    """YTM based on Bid price (what you get when SELLING)"""
-    if r["Bid"] > 0:
-        clean_bid = r["Bid"] - r["Accrued"]
-        return calculate_ytm(clean_bid, r["Coupon"], r["Years"])
-    elif r["LTP"] > 0:
-        clean_ltp = r["LTP"] - r["Accrued"]
-        return calculate_ytm(clean_ltp, r["Coupon"], r["Years"])
-    return None
+    return df
 
-df["Bid YTM"] = df.apply(get_bid_ytm, axis=1)
-
-# =====================================================
-# ASK YTM (BUYING YIELD)
-# =====================================================
-def get_ask_ytm(r):
-    """YTM based on Ask price (what you get when BUYING)"""
-    if r["Ask"] > 0:
-        clean_ask = r["Ask"] - r["Accrued"]
-        return calculate_ytm(clean_ask, r["Coupon"], r["Years"])
-    elif r["LTP"] > 0:
-        clean_ltp = r["LTP"] - r["Accrued"]
-        return calculate_ytm(clean_ltp, r["Coupon"], r["Years"])
-    return None
-
-df["Ask YTM"] = df.apply(get_ask_ytm, axis=1)
-
-# =====================================================
-# BID-ASK SPREAD
-# =====================================================
-df["Spread"] = df["Ask"] - df["Bid"]
+df = build_enriched(live, master, master_mtime, tuple(series_filter), SETTLEMENT, exact_ytm)
 
 # =====================================================
 # YIELD HISTORY TRACKING
 # =====================================================
 def update_yield_history(df):
     """Track 7-day yield history"""
-    history = load_yield_history()
+    history = load_yield_history(history_stamp())
     today = datetime.now().strftime("%Y-%m-%d")
     
-    if today not in history:
-        history[today] = {}
-    
-    for _, row in df.iterrows():
-        sym = row["Symbol"]
-        if pd.notna(row["Bid YTM"]):
-            if sym not in history[today]:
-                history[today][sym] = {
-                    "bid_ytm": row["Bid YTM"],
-                    "ask_ytm": row["Ask YTM"] if pd.notna(row["Ask YTM"]) else None,
-                    "volume": row["Volume"]
-                }
+    day = history.setdefault(today, {})
+
+    # Bonds with a Bid YTM that aren't in today's snapshot yet (first quote wins)
+    new = df[df["Bid YTM"].notna()].drop_duplicates("Symbol")
+    new = new[~new["Symbol"].isin(list(day))]
+
+    ask = new["Ask YTM"].astype(object).where(new["Ask YTM"].notna(), None)
+    day.update(
+        (sym, {"bid_ytm": bid, "ask_ytm": ask_ytm, "volume": vol})
+        for sym, bid, ask_ytm, vol in zip(
+            new["Symbol"].tolist(),
+            new["Bid YTM"].tolist(),
+            ask.tolist(),
+            new["Volume"].tolist(),
+        )
+    )
+    added = not new.empty
     
     # Keep only last 7 days
-    all_dates = sorted(history.keys())
-    if len(all_dates) > 7:
-        for old_date in all_dates[:-7]:
-            del history[old_date]
+    stale = sorted(history.keys())[:-7]
+    for old_date in stale:
+        del history[old_date]
     
-    save_yield_history(history)
+    # A symbol is recorded once per day, so most reruns change nothing:
+    # only rewrite the file when a bond was added or a day dropped off
+    if added or stale:
+        save_yield_history(history)
     return history
 
-history = update_yield_history(df)
+# Approximate yields aren't comparable with the exact ones on file: never record them
+if exact_ytm:
+    history = update_yield_history(df)
+else:
+    history = load_yield_history(history_stamp())
 
 # =====================================================
 # 7-DAY AVERAGE YIELD
 # =====================================================
-def get_7d_avg_yield(symbol, history):
-    """Calculate 7-day average for Bid YTM and Ask YTM"""
-    bid_yields = []
-    ask_yields = []
-    volumes = []
-    
-    for date_data in history.values():
-        if symbol in date_data:
-            if date_data[symbol]["bid_ytm"]:
-                bid_yields.append(date_data[symbol]["bid_ytm"])
-            if date_data[symbol]["ask_ytm"]:
-                ask_yields.append(date_data[symbol]["ask_ytm"])
-            if date_data[symbol]["volume"]:
-                volumes.append(date_data[symbol]["volume"])
-    
-    return {
-        "bid_avg": sum(bid_yields) / len(bid_yields) if bid_yields else None,
-        "ask_avg": sum(ask_yields) / len(ask_yields) if ask_yields else None,
-        "vol_avg": sum(volumes) / len(volumes) if volumes else None
-    }
+# Saved history matches the file, so its stamp keys the averages too
+@st.cache_data(max_entries=2)
+def get_7d_avg_yields(_history, stamp):
+    """7-day average Bid YTM, Ask YTM and volume per symbol (one pass over history)"""
+    rows = [
+        (sym, rec["bid_ytm"], rec["ask_ytm"], rec["volume"])
+        for date_data in _history.values()
+        for sym, rec in date_data.items()
+    ]
+    h = pd.DataFrame(rows, columns=["Symbol", "bid_avg", "ask_avg", "vol_avg"])
+    h = h.set_index("Symbol").astype(float)
+
+    # Missing / zero entries don't count towards the average
+    return h.where(h != 0).groupby(level=0).mean()
+
+avg_7d = get_7d_avg_yields(history, history_stamp())
+symbols = df["Symbol"].astype(object)
+for col in avg_7d.columns:
+    df[col] = symbols.map(avg_7d[col])
 
-df["7D Avg"] = df["Symbol"].apply(lambda s: get_7d_avg_yield(s, history))
+# ...nor diff them against exact averages (NaN keeps the BUY/SELL rules quiet)
+if not exact_ytm:
+    df[["bid_avg", "ask_avg"]] = np.nan
 
 # =====================================================
 # OPPORTUNITY SCANNER
 # =====================================================
-def generate_opportunities(df, threshold, vol_mult, min_vol):
+def generate_opportunities(df, threshold, vol_mult, min_vol, top_n):
     """Generate trading opportunities"""
-    opportunities = []
-    
-    for _, r in df.iterrows():
-        if r["Volume"] < min_vol:
-            continue
-        
-        avg_data = r["7D Avg"]
-        signals = []
-        
+    d = df[df["Volume"] >= min_vol]
+
+    ask_diff = d["Ask YTM"] - d["ask_avg"]
+    bid_diff = d["bid_avg"] - d["Bid YTM"]
+    vol_ratio = d["Volume"] / d["vol_avg"]
+    spread = d["Spread"]
+
+    # (mask, signal, reason template, reason value, priority); NaN compares False
+    rules = [
         # High Ask YTM = BUY opportunity
-        if pd.notna(r["Ask YTM"]) and avg_data["ask_avg"]:
-            diff = r["Ask YTM"] - avg_data["ask_avg"]
-            if diff > threshold:
-                signals.append({
-                    "Symbol": r["Symbol"],
-                    "Bid YTM": r["Bid YTM"],
-                    "Ask YTM": r["Ask YTM"],
-                    "Signal": "🟢 BUY",
-                    "Reason": f"Ask YTM +{diff:.2f}% vs 7D avg",
-                    "Priority": diff  # for sorting
-                })
-        
+        (ask_diff > threshold, "🟢 BUY", "Ask YTM +{:.2f}% vs 7D avg", ask_diff, ask_diff),
         # Low Bid YTM = SELL opportunity
-        if pd.notna(r["Bid YTM"]) and avg_data["bid_avg"]:
-            diff = avg_data["bid_avg"] - r["Bid YTM"]
-            if diff > threshold:
-                signals.append({
-                    "Symbol": r["Symbol"],
-                    "Bid YTM": r["Bid YTM"],
-                    "Ask YTM": r["Ask YTM"],
-                    "Signal": "🔴 SELL",
-                    "Reason": f"Bid YTM -{diff:.2f}% vs 7D avg",
-                    "Priority": diff
-                })
-        
+        (bid_diff > threshold, "🔴 SELL", "Bid YTM -{:.2f}% vs 7D avg", bid_diff, bid_diff),
         # Volume spike
-        if avg_data["vol_avg"] and r["Volume"] > avg_data["vol_avg"] * vol_mult:
-            mult = r["Volume"] / avg_data["vol_avg"]
-            signals.append({
-                "Symbol": r["Symbol"],
-                "Bid YTM": r["Bid YTM"],
-                "Ask YTM": r["Ask YTM"],
-                "Signal": "⚡ VOLUME",
-                "Reason": f"Volume {mult:.1f}x avg",
-                "Priority": mult
-            })
-        
+        (d["Volume"] > d["vol_avg"] * vol_mult, "⚡ VOLUME", "Volume {:.1f}x avg", vol_ratio, vol_ratio),
         # Tight spread = good liquidity
-        if r["Spread"] > 0 and r["Spread"] < 0.10:
-            signals.append({
-                "Symbol": r["Symbol"],
-                "Bid YTM": r["Bid YTM"],
-                "Ask YTM": r["Ask YTM"],
-                "Signal": "💎 LIQUID",
-                "Reason": f"Tight spread ({r['Spread']:.2f})",
-                "Priority": 0.10 - r["Spread"]
-            })
-        
-        opportunities.extend(signals)
-    
-    # Sort by priority and return top N
-    opportunities.sort(key=lambda x: x["Priority"], reverse=True)
-    return opportunities[:max_opportunities]
+        ((spread > 0) & (spread < 0.10), "💎 LIQUID", "Tight spread ({:.2f})", spread, 0.10 - spread),
+    ]
+
+    frames = []
+    for order, (mask, signal, reason, value, priority) in enumerate(rules):
+        hit = d[mask]
+        frames.append(pd.DataFrame({
+            "Symbol": hit["Symbol"],
+            "Bid YTM": hit["Bid YTM"],
+            "Ask YTM": hit["Ask YTM"],
+            "Signal": signal,
+            "Reason": value[mask].map(reason.format),
+            "Priority": priority[mask],
+            "Row": np.flatnonzero(mask),
+            "Order": order,
+        }))
+
+    # Highest priority first; ties keep row order, then BUY/SELL/VOLUME/LIQUID
+    opportunities = pd.concat(frames, ignore_index=True).sort_values(
+        ["Priority", "Row", "Order"], ascending=[False, True, True]
+    )
+    return opportunities.head(top_n).reset_index(drop=True)
 
-opportunities = generate_opportunities(df, yield_threshold, volume_multiplier, min_volume)
+opportunities = generate_opportunities(
+    df, yield_threshold, volume_multiplier, min_volume, max_opportunities
+)
+
+# =====================================================
+# DISPLAY HELPERS
+# =====================================================
+def fmt_pct(s):
+    """YTM column as 2dp percent strings, "—" where missing"""
+    return s.map("{:.2f}%".format, na_action="ignore").fillna("—")
 
 # =====================================================
 # OPPORTUNITY SCANNER DISPLAY
 # =====================================================
 st.subheader("🚨 Opportunity Scanner")
 
-if opportunities:
-    opp_df = pd.DataFrame(opportunities)
-    opp_df = opp_df[["Symbol", "Bid YTM", "Ask YTM", "Signal", "Reason"]]
+if not opportunities.empty:
+    opp_df = opportunities[["Symbol", "Bid YTM", "Ask YTM", "Signal", "Reason"]].copy()
     
     # Format YTM columns
-    opp_df["Bid YTM"] = opp_df["Bid YTM"].apply(lambda x: f"{x:.2f}%" if pd.notna(x) else "—")
-    opp_df["Ask YTM"] = opp_df["Ask YTM"].apply(lambda x: f"{x:.2f}%" if pd.notna(x) else "—")
+    opp_df["Bid YTM"] = fmt_pct(opp_df["Bid YTM"])
+    opp_df["Ask YTM"] = fmt_pct(opp_df["Ask YTM"])
     
     st.dataframe(
         opp_df,
@@ -498,36 +636,27 @@ else:
 # =====================================================
 # ALERT LOGIC
 # =====================================================
-def alert_status(r):
-    a = st.session_state.alerts.get(r["Symbol"])
-    if not a or a["target"] == 0:
-        return "—"
-
-    side, target, tol = a["side"], a["target"], a["tolerance"]
-
-    if side == "SELL":
-        bid = r["Bid"]
-        if bid == 0:
-            return "—"
-        if bid >= target:
-            return "HIT"
-        elif (target - bid) <= tol:
-            return "NEAR"
-        else:
-            return "FAR"
-
-    if side == "BUY":
-        ask = r["Ask"]
-        if ask == 0:
-            return "—"
-        if ask <= target:
-            return "HIT"
-        elif (ask - target) <= tol:
-            return "NEAR"
-        else:
-            return "FAR"
-
-    return "—"
+def alert_status(wdf):
+    """HIT / NEAR / FAR / — for every watchlist row at once"""
+    alerts = st.session_state.alerts
+    sym = wdf["Symbol"].astype(object)
+    side = sym.map({k: a["side"] for k, a in alerts.items()}).to_numpy()
+    target = sym.map({k: a["target"] for k, a in alerts.items()}).to_numpy(dtype=float)
+    tol = sym.map({k: a["tolerance"] for k, a in alerts.items()}).to_numpy(dtype=float)
+
+    sell = side == "SELL"
+    buy = side == "BUY"
+    px = np.where(sell, wdf["Bid"], wdf["Ask"])
+
+    # Distance still to go before the target is reached (<= 0 means reached)
+    gap = np.where(sell, target - px, px - target)
+    armed = (sell | buy) & (target != 0) & (px != 0)
+
+    return np.select(
+        [~armed, gap <= 0, gap <= tol],
+        ["—", "HIT", "NEAR"],
+        default="FAR",
+    )
 
 # =====================================================
 # MARKET VIEW
@@ -554,8 +683,8 @@ cols = [
 
 # Format display
 display_df = df[cols].copy()
-display_df["Bid YTM"] = display_df["Bid YTM"].apply(lambda x: f"{x:.2f}%" if pd.notna(x) else "—")
-display_df["Ask YTM"] = display_df["Ask YTM"].apply(lambda x: f"{x:.2f}%" if pd.notna(x) else "—")
+display_df["Bid YTM"] = fmt_pct(display_df["Bid YTM"])
+display_df["Ask YTM"] = fmt_pct(display_df["Ask YTM"])
 
 st.dataframe(display_df, use_container_width=True)
 
@@ -564,7 +693,8 @@ st.dataframe(display_df, use_container_width=True)
 # =====================================================
 st.subheader("Watchlist")
 
-all_symbols = sorted(df["Symbol"].unique())
+# Symbol shares master's (already sorted) categories: no per-rerun Python sort
+all_symbols = df["Symbol"].cat.remove_unused_categories().cat.categories.tolist()
 
 quick_add = st.selectbox(
     "Add bond (type to search)",
@@ -572,74 +702,84 @@ quick_add = st.selectbox(
 )
 
 if quick_add and quick_add not in st.session_state.watchlist:
-    st.session_state.watchlist.append(quick_add)
-    save_persistent_state()
+    st.session_state.watchlist[quick_add] = None
+    mark_state_dirty()
 
 paste = st.text_area("Paste from Excel (one per line)")
 
 if st.button("➕ Add pasted"):
     items = [x.strip().upper() for x in paste.splitlines() if x.strip()]
-    st.session_state.watchlist = list(
-        dict.fromkeys(st.session_state.watchlist + items)
-    )
-    save_persistent_state()
+    st.session_state.watchlist.update(dict.fromkeys(items))
+    mark_state_dirty()
 
 # =====================================================
 # ALERT SETUP
 # =====================================================
 st.markdown("### 🎯 Alert Setup")
 
-alert_sym = st.selectbox(
-    "Bond",
-    [""] + st.session_state.watchlist
-)
+# Fragment: picking a bond / typing a target only reruns this block,
+# not the live load + enrichment + tables above
+@st.fragment
+def alert_setup():
+    alert_sym = st.selectbox(
+        "Bond",
+        [""] + list(st.session_state.watchlist)
+    )
+
+    if alert_sym:
+        c1, c2, c3 = st.columns(3)
 
-if alert_sym:
-    c1, c2, c3 = st.columns(3)
+        with c1:
+            side = st.selectbox("Side", ["BUY", "SELL"])
+        with c2:
+            target = st.number_input("Target", format="%.2f")
+        with c3:
+            tol = st.number_input("Tolerance", value=0.02, format="%.2f")
 
-    with c1:
-        side = st.selectbox("Side", ["BUY", "SELL"])
-    with c2:
-        target = st.number_input("Target", format="%.2f")
-    with c3:
-        tol = st.number_input("Tolerance", value=0.02, format="%.2f")
+        if st.button("💾 Save Alert"):
+            st.session_state.alerts[alert_sym] = {
+                "side": side,
+                "target": target,
+                "tolerance": tol,
+            }
+            mark_state_dirty()
+            # Full rerun so the watchlist table picks up the new alert
+            st.rerun()
 
-    if st.button("💾 Save Alert"):
-        st.session_state.alerts[alert_sym] = {
-            "side": side,
-            "target": target,
-            "tolerance": tol,
-        }
-        save_persistent_state()
+alert_setup()
 
 # =====================================================
 # WATCHLIST TABLE + SOUND
 # =====================================================
 if st.session_state.watchlist:
-    wdf = df[df["Symbol"].isin(st.session_state.watchlist)].copy()
-    wdf["ALERT"] = wdf.apply(alert_status, axis=1)
-
-    for _, r in wdf.iterrows():
-        sym = r["Symbol"]
-        new = r["ALERT"]
-        old = st.session_state.last_alert_state.get(sym)
-
-        if new != old:
-            if new == "NEAR":
-                play_near_sound()
-            elif new == "HIT":
-                play_hit_sound()
-
-        st.session_state.last_alert_state[sym] = new
-
-    def style(v):
-        if v == "HIT":
-            return "background-color:#ff4d4d;color:white;"
-        if v == "NEAR":
-            return "background-color:#ffa500;"
-        if v == "FAR":
-            return "background-color:#e0e0e0;"
-        return ""
+    # Hash lookup on the Symbol index instead of scanning every row with isin
+    df_by_sym = df.set_index("Symbol", drop=False)
+    wdf = df_by_sym.loc[
+        df_by_sym.index.intersection(list(st.session_state.watchlist))
+    ].reset_index(drop=True)
+    wdf["ALERT"] = alert_status(wdf)
+
+    # Diff against last rerun's states in one pass; at most one beep per kind
+    last_state = st.session_state.last_alert_state
+    sym = wdf["Symbol"].astype(object)
+    changed = set(wdf["ALERT"][wdf["ALERT"].ne(sym.map(last_state))])
+
+    if "HIT" in changed:
+        play_hit_sound()
+    if "NEAR" in changed:
+        play_near_sound()
+
+    last_state.update(zip(sym, wdf["ALERT"]))
+
+    ALERT_CSS = {
+        "HIT": "background-color:#ff4d4d;color:white;",
+        "NEAR": "background-color:#ffa500;",
+        "FAR": "background-color:#e0e0e0;",
+    }
+
+    def style(col):
+        # One dict lookup per column instead of a Python call per cell
+        return col.map(ALERT_CSS).fillna("")
 
     wcols = [
         "Symbol", "Series", "Bid", "Ask", "LTP", "Volume",
@@ -647,20 +787,32 @@ if st.session_state.watchlist:
     ]
 
     wdf_display = wdf[wcols].copy()
-    wdf_display["Bid YTM"] = wdf_display["Bid YTM"].apply(lambda x: f"{x:.2f}%" if pd.notna(x) else "—")
-    wdf_display["Ask YTM"] = wdf_display["Ask YTM"].apply(lambda x: f"{x:.2f}%" if pd.notna(x) else "—")
+    wdf_display["Bid YTM"] = fmt_pct(wdf_display["Bid YTM"])
+    wdf_display["Ask YTM"] = fmt_pct(wdf_display["Ask YTM"])
 
     st.dataframe(
-        wdf_display.style.applymap(style, subset=["ALERT"]),
+        wdf_display.style.apply(style, subset=["ALERT"]),
         use_container_width=True,
     )
 
-    remove = st.multiselect("Remove bonds", st.session_state.watchlist)
+    # Fragment: ticking bonds to remove doesn't rerun the whole app
+    @st.fragment
+    def remove_bonds():
+        remove = st.multiselect("Remove bonds", list(st.session_state.watchlist))
 
-    if st.button("❌ Remove"):
-        st.session_state.watchlist = [
-            x for x in st.session_state.watchlist if x not in remove
-        ]
-        save_persistent_state()
+        if st.button("❌ Remove"):
+            for x in remove:
+                st.session_state.watchlist.pop(x, None)
+            mark_state_dirty()
+            st.rerun()
+
+    remove_bonds()
 else:
     st.info("Watchlist empty.")
+
+# =====================================================
+# FLUSH USER STATE
+# =====================================================
+# Widgets above only mark the state dirty; write it once, at the end of the rerun
+if st.session_state.get("state_dirty"):
+    save_persistent_state()
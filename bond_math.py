@@ -0,0 +1,147 @@
+import pandas as pd
+import numpy as np
+from datetime import datetime, timedelta
+
+# =====================================================
+# SETTLEMENT DATE (INDIA T+1)
+# =====================================================
+def get_settlement_date():
+    today = datetime.today().date()
+    wd = today.weekday()
+
+    if wd <= 3:
+        return today + timedelta(days=1)
+    elif wd == 4:
+        return today + timedelta(days=3)
+    else:
+        return today + timedelta(days=2)
+
+# =====================================================
+# 30/360 US (EXCEL MATCH)
+# =====================================================
+def days360_us(start, end):
+    """30/360 US day count from a Series of start dates to a single end date"""
+    d1 = start.dt.day.to_numpy()
+    m1 = start.dt.month.to_numpy()
+    y1 = start.dt.year.to_numpy()
+    d2, m2, y2 = end.day, end.month, end.year
+
+    d1 = np.where(d1 == 31, 30, d1)
+    d2 = np.where((d2 == 31) & (d1 == 30), 30, d2)
+
+    return 360 * (y2 - y1) + 30 * (m2 - m1) + (d2 - d1)
+
+# =====================================================
+# LAST INTEREST PAID + ACCRUED
+# =====================================================
+def last_coupon_date(redemption, settlement):
+    """Last coupon on/before settlement, stepping back 6 months at a time from redemption"""
+    red = pd.to_datetime(redemption)
+    ry = red.dt.year.to_numpy()
+    rm = red.dt.month.to_numpy()
+    rd = red.dt.day.to_numpy()
+
+    # Number of 6-month periods to step back from redemption
+    months_diff = (ry - settlement.year) * 12 + (rm - settlement.month)
+    k = np.ceil(months_diff / 6).astype(int)
+    # Same month: compare the coupon day as clamped to that month's length
+    settle_dim = pd.Timestamp(settlement).days_in_month
+    k = np.where(
+        (months_diff == 6 * k) & (np.minimum(rd, settle_dim) > settlement.day),
+        k + 1, k,
+    )
+    k = np.maximum(k, 0)
+
+    month_index = ry * 12 + (rm - 1) - 6 * k
+    first = pd.to_datetime(pd.DataFrame({
+        "year": month_index // 12,
+        "month": month_index % 12 + 1,
+        "day": 1,
+    }))
+
+    # Clamp to month end (e.g. 31-Aug redemption -> 28/29-Feb coupon)
+    day = np.minimum(rd, first.dt.days_in_month.to_numpy())
+    last = first + pd.to_timedelta(day - 1, unit="D")
+
+    return pd.Series(last.to_numpy(), index=redemption.index)
+
+# =====================================================
+# YTM CALCULATION HELPER
+# =====================================================
+def vector_ytm(n, c, p, f=100.0):
+    """Per-period yield for all bonds at once (Newton-Raphson on NumPy arrays)"""
+    n = np.asarray(n, dtype=float)
+    c = np.asarray(c, dtype=float)
+    p = np.asarray(p, dtype=float)
+
+    with np.errstate(all="ignore"):
+        # Seed with the textbook approximate yield, clipped to the -10%..50% band
+        y = np.clip((c + (f - p) / n) / ((f + p) / 2), -0.05, 0.25)
+
+        for _ in range(25):
+            v = (1 + y) ** -n
+            pv = c * (1 - v) / y + f * v
+            dpv_dy = (
+                c * (n * y * v / (1 + y) - (1 - v)) / y ** 2
+                - f * n * v / (1 + y)
+            )
+            step = (pv - p) / dpv_dy
+            y = y - step
+
+            # Good seed: most books converge in a handful of iterations
+            if not np.any(np.abs(step) > 1e-12):
+                break
+
+        # Mask rows that did not converge (or blew up to NaN/inf)
+        v = (1 + y) ** -n
+        pv = c * (1 - v) / y + f * v
+        converged = np.isfinite(y) & (np.abs(pv - p) < 1e-6)
+
+    return np.where(converged, y, np.nan)
+
+def calculate_ytm(price, coupon, years):
+    """Generic YTM calculator (vectorized, returns % with NaN where invalid)"""
+    price = np.asarray(price, dtype=float)
+    coupon = np.asarray(coupon, dtype=float)
+    years = np.asarray(years, dtype=float)
+
+    ytm = vector_ytm(years * 2, coupon / 2, price) * 2 * 100
+
+    valid = (price > 0) & (years > 0) & (coupon > 0) & (ytm > -10) & (ytm < 50)
+    return np.where(valid, ytm, np.nan)
+
+def approx_ytm(price, coupon, years):
+    """Closed-form approximate YTM in % (no iteration; fine for ranking)"""
+    price = np.asarray(price, dtype=float)
+    coupon = np.asarray(coupon, dtype=float)
+    years = np.asarray(years, dtype=float)
+
+    with np.errstate(all="ignore"):
+        ytm = (coupon + (100 - price) / years) / ((100 + price) / 2) * 100
+
+    valid = (price > 0) & (years > 0) & (coupon > 0) & (ytm > -10) & (ytm < 50)
+    return np.where(valid, ytm, np.nan)
+
+def quote_price(primary, ltp):
+    """Use the quoted price when present, else fall back to LTP"""
+    return np.where(primary > 0, primary, np.where(ltp > 0, ltp, np.nan))
+
+# =====================================================
+# BID / ASK YTM (SELLING / BUYING YIELD)
+# =====================================================
+def get_bid_ask_ytm(df, exact=True):
+    """Bid YTM (what you get when SELLING) + Ask YTM (what you get when BUYING)"""
+    # Both sides are stacked into one solver call so the Newton loop runs once
+    accrued = df["Accrued"].to_numpy()
+    coupon = df["Coupon"].to_numpy()
+    years = df["Years"].to_numpy()
+
+    clean = np.concatenate([
+        quote_price(df["Bid"], df["LTP"]) - accrued,
+        quote_price(df["Ask"], df["LTP"]) - accrued,
+    ])
+    solver = calculate_ytm if exact else approx_ytm
+    ytm = solver(clean, np.tile(coupon, 2), np.tile(years, 2))
+
+    bid_ytm, ask_ytm = np.split(ytm, 2)
+    return bid_ytm, ask_ytm
@@ -4,15 +4,23 @@ from plyer import notification
 
 STATE = Path("user_state.json")
 sent = {}
+last_stamp = None
 
 def notify(msg):
     notification.notify(title="Bond Alert", message=msg, timeout=5)
 
 while True:
-    if STATE.exists():
-        s=json.load(open(STATE))
+    # A stat per tick; only re-parse when the app has actually rewritten the file
+    try:
+        st = STATE.stat()
+        stamp = (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        stamp = None
+    if stamp and stamp != last_stamp:
+        last_stamp = stamp
+        s=json.loads(STATE.read_text())
         for k,v in s["alerts"].items():
-            if v["last_status"]=="HIT" and sent.get(k)!="HIT":
+            if v.get("last_status")=="HIT" and sent.get(k)!="HIT":
                 notify(f"{k} HIT @ {v['target']}")
                 sent[k]="HIT"
     time.sleep(5)